@@ -11,7 +11,7 @@
 
 import os
 import re
-import filetype
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 import cv2
@@ -23,6 +23,82 @@ import numpy as np
 
 from utlis import DICOM
 
+try:  # numba为可选依赖，缺失时退回纯NumPy实现
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+try:  # nibabel为可选依赖，用于内存映射读取未压缩.nii
+    import nibabel as nib
+except ImportError:
+    nib = None
+
+
+if hasattr(np, "bitwise_count"):  # NumPy >= 2.0 直接暴露硬件popcount
+    def _PopCount(packed: np.ndarray) -> int:
+        """统计packbits压缩数组中置位bit的个数"""
+        return int(np.bitwise_count(packed).sum())
+else:  # 旧版NumPy用256项查找表代替
+    _POPCOUNT_LUT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+    def _PopCount(packed: np.ndarray) -> int:
+        """统计packbits压缩数组中置位bit的个数"""
+        return int(_POPCOUNT_LUT[packed].sum())
+
+
+def _PackBits64(mask_flat: np.ndarray) -> np.ndarray:
+    """把bool掩码压缩为1bit/体素，按8字节对齐后以uint64数组返回"""
+    bits = np.packbits(mask_flat)
+    if bits.size % 8:
+        bits = np.concatenate([bits, np.zeros(8 - bits.size % 8, dtype=np.uint8)])
+    return bits.view(np.uint64)
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _BitOverlap(a, b):
+        """按位与后对uint64数组做SWAR popcount，不生成整卷临时数组"""
+        assert a.size == b.size, "packed mask size mismatch"
+        s = 0
+        for i in range(a.size):
+            v = a[i] & b[i]
+            v = v - ((v >> np.uint64(1)) & np.uint64(0x5555555555555555))
+            v = (v & np.uint64(0x3333333333333333)) + ((v >> np.uint64(2)) & np.uint64(0x3333333333333333))
+            v = (v + (v >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+            s += int((v * np.uint64(0x0101010101010101)) >> np.uint64(56))
+        return s
+else:
+    def _BitOverlap(a, b):
+        """按位与后对uint64数组做popcount"""
+        assert a.size == b.size, "packed mask size mismatch"
+        return _PopCount((a & b).view(np.uint8))
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _OverwriteMasked(seg_flat, organ_flat, ID):
+        """单次遍历的并行覆写核：器官非零处写入ID"""
+        for i in prange(seg_flat.size):
+            if organ_flat[i]:
+                seg_flat[i] = ID
+else:
+    def _OverwriteMasked(seg_flat, organ_flat, ID):
+        """单次遍历的并行覆写核：器官非零处写入ID"""
+        seg_flat[organ_flat != 0] = ID
+
+
+def _ReadOrganArray(fpath: str) -> np.ndarray:
+    """读取单器官分割文件为ndarray，读取、解压时释放GIL，可多线程并行
+
+    未压缩的.nii在安装nibabel时走内存映射，跳过解码时的整卷拷贝；
+    .nii.gz等压缩格式仍由sitk读取。nibabel的轴顺序为(x, y, z)，
+    转置为sitk的(z, y, x)顺序，两条路径返回一致的数组布局
+    """
+    if nib is not None and fpath.endswith(".nii"):
+        return np.asarray(nib.load(fpath, mmap=True).dataobj).T
+    return sitk.GetArrayFromImage(sitk.ReadImage(fpath))
+
 
 class SegmentBase(DICOM.DCMBase):
     def __init__(self):
@@ -90,30 +166,37 @@ class Jpg2niiConverter(SegmentFormatConverter):
         # 设置缺省值
         if GetImageLayerMethod is None:
             GetImageLayerMethod = self.GetImageLayerByName
-        # 根据原始图像生成空白背景
-        seg = np.zeros_like(sitk.GetArrayViewFromImage(self.img))
+        # 根据原始图像的尺寸生成空白背景，不触碰CT像素数据
+        seg = np.zeros(sitk.GetArrayViewFromImage(self.img).shape, dtype=np.uint8)
         # 先检查文件夹中是否有图片，防止生产空文件
         fnames = os.listdir(folder_jpg)
         if len(fnames) == 0:
             return 0
-        # 对每一张jpg进行处理，得到完整的CT图
+        # 预先计算每张jpg对应的层数，检验是否全部为jpg文件（按后缀判断，避免额外打开一次文件）
+        items = []
         for fname in fnames:
-            fpath = os.path.join(folder_jpg, fname)
-            kind = filetype.guess(fpath)  # 检验是否全部为jpg文件
-            assert kind.extension == 'jpg', "Wrong type in specified folder."
+            assert fname.lower().endswith((".jpg", ".jpeg")), "Wrong type in specified folder."
+            items.append((GetImageLayerMethod(fname), os.path.join(folder_jpg, fname)))
+
+        def _ReadSlice(item):
+            z, fpath = item
             seg_slice = cv2.imread(filename=fpath, flags=0)  # 读取文件为灰度图
             assert np.shape(seg_slice) == (512, 512), f"{fpath} has different size from (512, 512)"
-            z = GetImageLayerMethod(fname)  # 获取对应的层数
-            seg[z] = seg_slice
+            return z, seg_slice
+
+        # JPEG解码独立且释放GIL，线程池并行读取全部切片，得到完整的CT图
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for z, seg_slice in executor.map(_ReadSlice, items):
+                seg[z] = seg_slice
 
-        # jpg图片读取后有非0或255的数，需要处理, 以250为界限
-        seg[seg > threshold] = 255
-        seg[seg <= threshold] = 0
+        # jpg图片读取后有非0或255的数，需要处理, 以250为界限，单次遍历完成二值化
+        seg = np.where(seg > threshold, np.uint8(255), np.uint8(0))
 
         # 转换为Image
-        seg = sitk.GetImageFromArray(seg)  # 输出需要完全翻转才能跟dcm一致
+        # 输出需要完全翻转才能跟dcm一致；如需翻转，应在读取循环中按 seg[n_slices - 1 - z] 放置切片，
+        # 而不是对整个体素数组做np.flip（GetImageFromArray会强制连续拷贝翻转后的视图）
+        seg = sitk.GetImageFromArray(seg)  # 数组已是uint8，无需再Cast
         seg.CopyInformation(self.img)
-        seg = sitk.Cast(image=seg, pixelID=sitk.sitkUInt8)
         # 创建保存所有器官分割结果的文件夹
         folder_save = os.path.dirname(fpath_save)
         if not os.path.exists(folder_save):
@@ -193,8 +276,10 @@ class SegmentAssembleImageFilter(SegmentBase):
         self.folder_organs = None
         self.fpath_list = []
         self.fname_list = []
+        self.fpath_by_fname = {}
         self.fpath_save = None
         self.OrganID = {}
+        self._ordered_organs = ()
 
     def SetFpathList(self, folder_organs=None, fpath_list=None):
         """
@@ -210,6 +295,8 @@ class SegmentAssembleImageFilter(SegmentBase):
             self.fpath_list = fpath_list
 
         self.fname_list = [fpath.split("\\")[-1] for fpath in self.fpath_list]
+        # 文件名到路径的映射，避免循环中反复线性查找
+        self.fpath_by_fname = dict(zip(self.fname_list, self.fpath_list))
 
         return self.fpath_list
 
@@ -221,6 +308,9 @@ class SegmentAssembleImageFilter(SegmentBase):
         :return: 文件名-ID字典
         """
         self.OrganID = organ_id_dick
+        # 预先展开覆写顺序、文件名与ID，Execute热循环中不再拼接字符串、查找字典
+        self._ordered_organs = tuple((organ_name, organ_name + ".nii", organ_id)
+                                     for organ_name, organ_id in organ_id_dick.items())
         # 判断列表中全部文件是否都在选定的ID_dick中
         fnames_miss = [fname[0:-4] for fname in self.fname_list if fname[0:-4] not in self.OrganID]
         assert len(fnames_miss) == 0, f"Organ ID dict and organs miss match.{fnames_miss}"
@@ -233,24 +323,39 @@ class SegmentAssembleImageFilter(SegmentBase):
         # 获取全部器官list，去除缺省值
         organs = os.listdir(self.folder_organs)
         organs = [organ for organ in organs if organ not in stop_organ_list]
+        # 每个器官只读取、解码一次，packbits压缩为1bit/体素后缓存，节省8倍内存
+        # 读取、解压为IO密集且释放GIL，用线程池并行
+        def _LoadPacked(organ):
+            arr = _ReadOrganArray(os.path.join(self.folder_organs, organ))
+            return arr.shape, _PackBits64(arr.astype(bool, copy=False).ravel())
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = dict(zip(organs, executor.map(_LoadPacked, organs)))
+        # packbits丢失了形状信息，缓存前检验各器官尺寸一致，防止错位比较
+        shapes = {organ: shape for organ, (shape, _) in results.items()}
+        assert len(set(shapes.values())) <= 1, f"Organ masks have mismatched shapes: {shapes}"
+        packed = {organ: bits for organ, (_, bits) in results.items()}
+        counts = {organ: _PopCount(bits.view(np.uint8)) for organ, bits in packed.items()}
         # 对器官进行循环比较，输出重叠较大的器官
         for i in range(len(organs)):
             for j in range(i + 1, len(organs)):
                 # 器官名称
                 organ_i = organs[i][0:-4]
                 organ_j = organs[j][0:-4]
-                # 读取器官图像
-                img_i = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(self.folder_organs, organs[i]))).astype(bool)
-                img_j = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(self.folder_organs, organs[j]))).astype(bool)
+                # 读取缓存的器官图像（bit压缩）
+                bits_i = packed[organs[i]]
+                bits_j = packed[organs[j]]
                 # 计算器官体积点数
-                n_i = np.sum(img_i)
-                n_j = np.sum(img_j)
-                # 分析重合情况
-                overlap = np.sum(img_i * img_j)
-                percent_i = (overlap / n_i * 100).round(decimals=1)
-                percent_j = (overlap / n_j * 100).round(decimals=1)
-                ratio = (n_i / n_j).round(2)
-                if overlap != 0 and (percent_i >= 1 or percent_j >= 1):
+                n_i = counts[organs[i]]
+                n_j = counts[organs[j]]
+                # 分析重合情况：按位与后popcount（有numba时无临时数组）
+                overlap = int(_BitOverlap(bits_i, bits_j))
+                if overlap == 0:  # 无重合时跳过百分比计算
+                    continue
+                percent_i = round(overlap / n_i * 100, 1)
+                percent_j = round(overlap / n_j * 100, 1)
+                ratio = round(n_i / n_j, 2)
+                if percent_i >= 1 or percent_j >= 1:
                     print(f"Overlap Points: {overlap} ({percent_i}%, {percent_j}%)", end="\t\t\t")
                     print(f"{organ_i}: {n_i};\t{organ_j}: {n_j};\t{ratio}")
         return 0
@@ -258,29 +363,29 @@ class SegmentAssembleImageFilter(SegmentBase):
     def Execute(self, fpath_save):
         # 根据其中任一分割图像生成空白分割背景
         ref = sitk.ReadImage(self.fpath_list[0])
-        seg = np.zeros_like(sitk.GetArrayViewFromImage(ref)).astype(np.uint8)
-        seg_bool = seg.astype(bool)
-
-        # 按照顺序对OrganID中的器官进行覆写
-        pbar = tqdm(self.OrganID)
-        for organ_name in pbar:  # 对字典中的器官名进行循环
-            fname = organ_name + ".nii"
-            # 在文件夹中寻找器官
-            if fname in self.fname_list:
-                fpath = self.fpath_list[self.fname_list.index(fname)]
+        seg = np.zeros(sitk.GetArrayViewFromImage(ref).shape, dtype=np.uint8)
+
+        # 筛选文件夹中存在的器官，保持OrganID中的覆写顺序（顺序与文件名已预先展开）
+        organ_items = [(organ_name, fname, organ_id) for organ_name, fname, organ_id in self._ordered_organs
+                       if fname in self.fpath_by_fname]
+        # 各器官尺寸一致，复用一块uint8缓冲区，避免每个器官新分配整卷内存
+        scratch = np.empty(seg.shape, dtype=np.uint8)
+        # 线程池预读器官文件，主线程按顺序覆写，保证覆写语义不变
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {organ_name: executor.submit(sitk.ReadImage, self.fpath_by_fname[fname])
+                       for organ_name, fname, organ_id in organ_items}
+            pbar = tqdm(organ_items)
+            for organ_name, fname, organ_id in pbar:  # 按预展开的器官顺序循环
                 pbar.set_description(desc="Assemble organs: %s" % organ_name)
-                # 读取器官为数组，转换bool值
-                organ = sitk.GetArrayFromImage(sitk.ReadImage(fpath))
-                organ_bool = organ.astype(bool)
-                # 算差集, 将新器官添加到seg中
-                seg_minus_organ = seg_bool ^ (seg_bool & organ_bool)
-                seg = seg * seg_minus_organ + organ_bool * self.OrganID[organ_name]
-                seg_bool = seg.astype(bool)
-        pbar.close()
-
-        seg = sitk.GetImageFromArray(seg)
+                # 以只读视图取出器官数组，拷贝进复用缓冲区
+                organ_view = sitk.GetArrayViewFromImage(futures[organ_name].result())
+                np.copyto(scratch, organ_view, casting='unsafe')
+                # 单次遍历覆写器官所在的体素（有numba时多核并行）
+                _OverwriteMasked(seg.ravel(), scratch.ravel(), organ_id)
+            pbar.close()
+
+        seg = sitk.GetImageFromArray(seg)  # 数组已是uint8，无需再Cast
         seg.CopyInformation(ref)
-        seg = sitk.Cast(seg, sitk.sitkUInt8)
         sitk.WriteImage(seg, fpath_save)
         return seg
 
@@ -314,14 +419,10 @@ class SegmentSplitImageFilter(SegmentBase):
 
     @staticmethod
     def _AssembleMultipleOrgans(seg, ID_main):
-        # 创建一个空白的背景
-        seg_organ_main = np.zeros_like(seg)
-        for ID in SegmentSplitImageFilter.MultipleOrgans[ID_main]:
-            # 提取各器官，然后加到总分割图中
-            seg_organ = np.copy(seg)
-            seg_organ[seg != ID] = 0
-            seg_organ[seg == ID] = 255
-            seg_organ_main += seg_organ
+        # 一次isin得到全部子器官的合并掩码，避免逐ID的整卷临时数组与累加
+        mask = np.isin(seg, SegmentSplitImageFilter.MultipleOrgans[ID_main])
+        seg_organ_main = np.zeros(seg.shape, dtype=np.uint8)
+        seg_organ_main[mask] = 255
         return seg_organ_main
 
     def Execute(self, folder_save=None):
@@ -334,25 +435,54 @@ class SegmentSplitImageFilter(SegmentBase):
         # 读取全器官文件
         seg_img = sitk.ReadImage(self.fpath_seg)  # Image，用于拷贝信息
         seg = sitk.GetArrayFromImage(seg_img)  # ndarray，用于运算
-        # 对器官ID值进行循环，保存单独器官
-        pbar = tqdm(SegmentSplitImageFilter.StandardName)
-        for ID in pbar:
-            if ID in seg:
-                pbar.set_description("Splitting organs: %s" % str(SegmentSplitImageFilter.StandardName[ID]))
+        # 一次性统计出现过的ID值，避免每个ID都全卷扫描
+        present = set(int(value) for value in np.unique(seg))
+        # 预先收集体素索引，器官掩码由索引直接构建，不再逐器官全卷扫描
+        # 只收集会按索引落盘的单器官ID：背景0与组合器官（走_AssembleMultipleOrgans）不缓存索引，
+        # 否则整卷体素的索引都被钉在内存里，白占约8字节/体素
+        needed = {ID for ID in present if ID in SegmentSplitImageFilter.StandardName
+                  and ID not in SegmentSplitImageFilter.MultipleOrgans}
+        # 沿Z轴分块扫描，块大小按L3容量估算：一块驻留缓存即可服务全部ID的比较
+        L3_BYTES = 32 * 2 ** 20
+        voxels_per_slice = seg.shape[1] * seg.shape[2]
+        slab = max(1, L3_BYTES // (voxels_per_slice * seg.itemsize * 2))
+        idx_parts = {ID: [] for ID in needed}
+        for z0 in range(0, seg.shape[0], slab):
+            slab_flat = seg[z0:z0 + slab].ravel()  # 连续切片，ravel为视图
+            offset = z0 * voxels_per_slice
+            for ID in needed:
+                idx = np.flatnonzero(slab_flat == ID)
+                if idx.size:
+                    idx_parts[ID].append(idx + offset)
+        idx_by_id = {ID: np.concatenate(parts) if parts else np.empty(0, dtype=np.intp)
+                     for ID, parts in idx_parts.items()}
+        # 对器官ID值进行循环，保存单独器官；文件写出相互独立且释放GIL，交给线程池并行
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            pending = []
+            pbar = tqdm(SegmentSplitImageFilter.StandardName)
+            for ID in pbar:
                 if ID in SegmentSplitImageFilter.MultipleOrgans:
-                    seg_organ = self._AssembleMultipleOrgans(seg, ID)
+                    found = any(sub in present for sub in SegmentSplitImageFilter.MultipleOrgans[ID])
                 else:
-                    seg_organ = np.copy(seg)
-                    seg_organ[seg != ID] = 0
-                    seg_organ[seg == ID] = 255
-
-                seg_organ = sitk.GetImageFromArray(seg_organ)
-                seg_organ.CopyInformation(seg_img)
-                seg_organ = sitk.Cast(seg_organ, sitk.sitkUInt8)
-
-                fpath = os.path.join(folder_save, str(ID) + '_' + SegmentSplitImageFilter.StandardName[ID] + ".nii")
-                sitk.WriteImage(seg_organ, fpath)
-        pbar.close()
+                    found = ID in present
+                if found:
+                    pbar.set_description("Splitting organs: %s" % str(SegmentSplitImageFilter.StandardName[ID]))
+                    if ID in SegmentSplitImageFilter.MultipleOrgans:
+                        seg_organ = self._AssembleMultipleOrgans(seg, ID)
+                    else:
+                        seg_organ = np.zeros(seg.size, dtype=np.uint8)
+                        seg_organ[idx_by_id[ID]] = 255
+                        seg_organ = seg_organ.reshape(seg.shape)
+
+                    seg_organ = sitk.GetImageFromArray(seg_organ)  # 数组已是uint8，无需再Cast
+                    seg_organ.CopyInformation(seg_img)
+
+                    fpath = os.path.join(folder_save, str(ID) + '_' + SegmentSplitImageFilter.StandardName[ID] + ".nii")
+                    pending.append(executor.submit(sitk.WriteImage, seg_organ, fpath))
+            pbar.close()
+            # 等待全部写出完成，暴露可能的IO异常
+            for future in pending:
+                future.result()
 
 
 if __name__ == "__main__":